@@ -0,0 +1,95 @@
+# Boot time benchmark for the device
+# soft resets the board over its USB REPL then polls it with NTP requests,
+# reporting ms to the first unsynchronised reply and the first stratum 1
+# reply, alongside the device's own view of the same (printed by ntpd.py)
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import time
+
+import ntppacket
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+# ctrl-c to stop whatever is running, ctrl-d to soft reset into main.py
+_SOFT_RESET = b'\x03\x03\x04'
+# ntpd.py prints these when it sends each kind of reply for the first time
+_DEVICE_MARKERS = (b'first unsynchronised reply', b'first stratum 1 reply', b'nic reports connected')
+
+def _ms_since(start):
+    return int((time.monotonic() - start) * 1000)
+
+def run(host, port=123, tty=None, timeout=600, interval_ms=10):
+    console = None
+    if tty != None:
+        if serial == None:
+            raise ImportError("resetting the board needs pyserial")
+        console = serial.Serial(tty, 115200, timeout=0)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    request = bytearray(ntppacket.NTP_PACKET_LEN)
+    buf = bytearray(90)
+    line = b''
+    results = {}
+    start = time.monotonic()
+    if console != None:
+        console.write(_SOFT_RESET)
+    else:
+        print("reset the board now")
+    next_send = 0
+    while _ms_since(start) < timeout * 1000 and 'stratum 1' not in results:
+        now = _ms_since(start)
+        if (now >= next_send):
+            t = time.time_ns()
+            ntppacket.fill_request(request, (t // 1000000000, ((t % 1000000000) << 32) // 1000000000))
+            sock.sendto(request, (host, port))
+            next_send = now + interval_ms
+        try:
+            n = sock.recv_into(buf)
+            reply = ntppacket.parse_reply(buf[:n])
+            if reply != None:
+                if (reply[1] == ntppacket.NTP_STRATUM_UNSYNCHRONISED):
+                    results.setdefault('unsynchronised', now)
+                elif (reply[1] == ntppacket.NTP_STRATUM_PRIMARY):
+                    results.setdefault('stratum 1', now)
+        except BlockingIOError:
+            pass
+        if console != None:
+            line += console.read(256)
+            while b'\n' in line:
+                text, line = line.split(b'\n', 1)
+                if any(m in text for m in _DEVICE_MARKERS):
+                    print("device:", text.decode('utf-8', 'replace').strip())
+        time.sleep(0.001)
+    for kind in ('unsynchronised', 'stratum 1'):
+        if kind in results:
+            print("host: first", kind, "reply after", results[kind], "ms")
+        else:
+            print("host: no", kind, "reply within", timeout, "s")
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='time from reset to first ntp replies')
+    parser.add_argument('host')
+    parser.add_argument('--port', type=int, default=123)
+    parser.add_argument('--tty', help='board REPL to soft reset it, eg /dev/ttyACM0')
+    parser.add_argument('--timeout', type=int, default=600)
+    args = parser.parse_args()
+    run(args.host, args.port, args.tty, args.timeout)
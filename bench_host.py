@@ -0,0 +1,94 @@
+# Scaling benchmark for ntpd_host
+# runs the host server on loopback with 1..N workers and hammers it with
+# client processes, reporting replies per second for each worker count
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import os
+import socket
+import time
+
+import ntpd_host
+import ntppacket
+
+# each client keeps this many requests in flight on each of its sockets,
+# several sockets so SO_REUSEPORT has distinct 4-tuples to spread
+_WINDOW = 16
+_SOCKETS = 4
+
+def _client(port, duration, results):
+    request = bytearray(ntppacket.NTP_PACKET_LEN)
+    request[0] = (4 << 3) | ntppacket.NTP_MODE_CLIENT
+    socks = []
+    for i in range(_SOCKETS):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(('127.0.0.1', port))
+        s.setblocking(False)
+        socks.append(s)
+    buf = bytearray(90)
+    for s in socks:
+        for i in range(_WINDOW):
+            s.send(request)
+    replies = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        idle = True
+        for s in socks:
+            try:
+                while True:
+                    s.recv_into(buf)
+                    replies += 1
+                    idle = False
+                    s.send(request)
+            except BlockingIOError:
+                pass
+        # anything dropped on loopback is gone for good, top the window up
+        if idle:
+            time.sleep(0.001)
+            for s in socks:
+                s.send(request)
+    results.put(replies)
+
+def run(workers, clients, duration, port):
+    state = ntpd_host.ClockState()
+    procs = ntpd_host.spawn(state, '127.0.0.1', port, workers, assume_locked=True)
+    # let the workers bind and the discipline process publish
+    time.sleep(0.5)
+    results = multiprocessing.Queue()
+    load = [multiprocessing.Process(target=_client, args=(port, duration, results)) for i in range(clients)]
+    for p in load:
+        p.start()
+    total = sum(results.get() for p in load)
+    for p in load:
+        p.join()
+    for p in procs:
+        p.terminate()
+        p.join()
+    state.close()
+    return total / duration
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='ntpd_host worker scaling benchmark')
+    parser.add_argument('--max-workers', type=int, default=len(os.sched_getaffinity(0)))
+    parser.add_argument('--clients', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--port', type=int, default=12300)
+    args = parser.parse_args()
+    print('workers  replies/s')
+    for n in range(1, args.max_workers + 1):
+        rate = run(n, args.clients, args.duration, args.port)
+        print('{:7d}  {:9.0f}'.format(n, rate))
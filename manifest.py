@@ -0,0 +1,38 @@
+# MicroPython manifest freezing ntpd into the firmware as bytecode, so
+# nothing is compiled at boot and the modules run from flash not RAM
+# normally used through "make firmware", see Makefile
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+include("$(PORT_DIR)/boards/manifest.py")
+
+freeze(".", (
+    "ntpd.py",
+    "ntppacket.py",
+    "syncedclock.py",
+    "syncedclock_rtc.py",
+    "refsource.py",
+    "gps.py",
+    "copernicus_gps.py",
+    "led_flashable.py",
+    "telemetry.py",
+    "ntpclient.py",
+))
+
+# asyn.py (from micropython-async) is needed too; the Makefile hands us
+# its location in the environment, manifests only expand their own $(VARS)
+import os
+if "ASYN_DIR" in os.environ:
+    freeze(os.environ["ASYN_DIR"], "asyn.py")
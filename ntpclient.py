@@ -0,0 +1,220 @@
+# Upstream NTP client
+# fallback reference for when the GPS isn't locked; queries all the
+# configured servers at once and feeds the selected offset to the clock
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    import uasyncio as asyncio
+    import usocket as socket
+    import uselect as select
+    from utime import ticks_ms, ticks_diff
+except ImportError:
+    import asyncio
+    import socket
+    import select
+    import time
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+    def ticks_diff(a, b):
+        return a - b
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+import ntppacket
+
+# samples kept per server for the clock filter
+_FILTER_LEN = const(8)
+# give up on outstanding replies after this many ms
+_TIMEOUT_MS = const(1000)
+# declare ourselves unsynced after this many polls with no usable reply
+_MAX_MISSED = const(8)
+# floor on how far from the median a server may be and still survive
+# selection, in 2^-32 s (about 1ms)
+_MIN_DISTANCE = const(1 << 22)
+# how fast a sample's dispersion grows with age, RFC 5905's 15ppm as
+# 2^-32 s per ms
+_PHI = const(64)
+
+# our socket is AF_INET, so ask for an ipv4 address (localhost can be ::1
+# on a host); older MicroPython getaddrinfo doesn't take a family
+def _resolve(host, port):
+    try:
+        return socket.getaddrinfo(host, port, socket.AF_INET)[0][-1]
+    except TypeError:
+        return socket.getaddrinfo(host, port)[0][-1]
+
+class _Server():
+    def __init__(self, host, port):
+        self.host = host
+        self.addr = _resolve(host, port)
+        # ipv4 address is our refid when this is the system peer
+        try:
+            self.refid = bytes(int(x) for x in self.addr[0].split('.'))
+        except (TypeError, ValueError, AttributeError):
+            self.refid = b'\x00\x00\x00\x00'
+        # (offset, delay, number, arrival ms), numbered so we know which
+        # we've used
+        self.samples = []
+        self.count = 0
+        self.used = -1
+        self.stratum = ntppacket.NTP_STRATUM_UNSYNCHRONISED
+        self.sent = None
+
+    # NTP clock filter, the sample with the lowest delay plus dispersion
+    # from its age is the least disturbed; as in RFC 5905 it's only of use
+    # if it's newer than the last one we used
+    def best(self):
+        if not self.samples:
+            return None
+        now = ticks_ms()
+        best = min(self.samples, key=lambda s: s[1] // 2 + ticks_diff(now, s[3]) * _PHI)
+        if (best[2] <= self.used):
+            return None
+        return best
+
+class NTPClient():
+    def __init__(self, clock, servers, poll=64, port=123):
+        self._clock = clock
+        self._servers = [_Server(host, port) for host in servers]
+        self._poll = poll
+        self._sendbuf = bytearray(ntppacket.NTP_PACKET_LEN)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('', 0))
+        self._poller = select.poll()
+        self._poller.register(self._sock, select.POLLIN)
+        self._epoch = clock.epoch()
+        self._missed = 0
+
+    def _forget(self):
+        for server in self._servers:
+            server.samples = []
+
+    # one request to every server, then gather whatever comes back in time
+    async def _query_all(self):
+        for i, server in enumerate(self._servers):
+            now = self._clock.local_now()
+            # low bits of the fraction are below our resolution, use them
+            # to tell the replies apart
+            server.sent = (now[0], (now[1] & ~0xff) | i)
+            ntppacket.fill_request(self._sendbuf, server.sent)
+            try:
+                self._sock.sendto(self._sendbuf, server.addr)
+            except OSError:
+                server.sent = None
+        waiting = sum(1 for s in self._servers if s.sent != None)
+        started = ticks_ms()
+        got = 0
+        while waiting and ticks_diff(ticks_ms(), started) < _TIMEOUT_MS:
+            # spin like _get_ntp_packet does, any sleep here lands in the
+            # arrival timestamp as one-way delay
+            if not self._poller.poll(0):
+                await asyncio.sleep(0)
+                continue
+            packet, addr = self._sock.recvfrom(90)
+            arrival = self._clock.local_now()
+            reply = ntppacket.parse_reply(packet)
+            if reply == None:
+                continue
+            li, stratum, origin, receive, transmit = reply
+            for server in self._servers:
+                if (server.sent != origin):
+                    continue
+                server.sent = None
+                waiting -= 1
+                if (li == 3 or stratum == ntppacket.NTP_STRATUM_INVALID or stratum + 1 >= ntppacket.NTP_STRATUM_UNSYNCHRONISED):
+                    break
+                offset = (ntppacket.timestamp_diff(receive, origin) + ntppacket.timestamp_diff(transmit, arrival)) // 2
+                delay = ntppacket.timestamp_diff(arrival, origin) - ntppacket.timestamp_diff(transmit, receive)
+                server.samples.append((offset, max(delay, 0), server.count, ticks_ms()))
+                server.count += 1
+                if (len(server.samples) > _FILTER_LEN):
+                    server.samples.pop(0)
+                server.stratum = stratum
+                got += 1
+                break
+        for server in self._servers:
+            server.sent = None
+        return got
+
+    # pick the servers whose offset +/- half their delay covers the median,
+    # and take the median of those; the lowest stratum then delay of the
+    # survivors is the system peer
+    def _select(self):
+        candidates = []
+        for server in self._servers:
+            best = server.best()
+            if best != None:
+                candidates.append((best[0], best[1], server))
+        if not candidates:
+            return None
+        offsets = sorted(c[0] for c in candidates)
+        median = offsets[len(offsets) // 2]
+        survivors = [c for c in candidates if abs(c[0] - median) <= c[1] // 2 + _MIN_DISTANCE]
+        if not survivors:
+            survivors = candidates
+        offsets = sorted(c[0] for c in survivors)
+        peer = min(survivors, key=lambda c: (c[2].stratum, c[1]))[2]
+        return (offsets[len(offsets) // 2], peer)
+
+    # sleep between polls a second at a time, so a step of the clock (the
+    # GPS setting the RTC drops what we were serving) gets a fresh query
+    # straight away rather than at the end of the poll interval
+    async def _wait(self, seconds):
+        for i in range(seconds):
+            if (self._clock.epoch() != self._epoch):
+                return
+            await asyncio.sleep(1)
+
+    async def run(self):
+        print("ntpclient: upstream servers",[s.host for s in self._servers])
+        while True:
+            # the reference clock has it, keep out of the way
+            if self._clock.isLocked():
+                self._forget()
+                await asyncio.sleep(1)
+                continue
+            # the clock was stepped, everything we had is relative to the old time
+            if (self._clock.epoch() != self._epoch):
+                self._epoch = self._clock.epoch()
+                self._forget()
+            got = await self._query_all()
+            selected = self._select() if got else None
+            if not got:
+                self._missed += 1
+                if (self._missed == _MAX_MISSED):
+                    print("ntpclient: no usable upstream replies")
+                    self._clock.ntp_lost()
+            else:
+                self._missed = 0
+            # nothing newer than what's already applied, leave the clock be
+            if (selected != None and not self._clock.isLocked()):
+                offset, peer = selected
+                self._clock.ntp_update(offset, peer.stratum + 1, peer.refid)
+                # stored samples are now relative to the corrected clock
+                # and the best of each has been used
+                for server in self._servers:
+                    server.samples = [(s[0] - offset, s[1], s[2], s[3]) for s in server.samples]
+                    best = server.best()
+                    if best != None:
+                        server.used = best[2]
+            # poll quickly until we've got something to serve
+            if (self._clock.source()[0] == ntppacket.NTP_STRATUM_UNSYNCHRONISED):
+                await self._wait(2)
+            else:
+                await self._wait(self._poll)
@@ -16,63 +16,33 @@
 # limitations under the License.
 
 import gc
+import utime
+
+# boot timings are measured from here, the earliest point we control
+_boot_ms = utime.ticks_ms()
 
 import uasyncio
 #import uasyncio.udp
 import usocket as socket
 import uselect
-from asyn import Event
-gc.collect()
-
-from led_flashable import LED_Flashable
-from pyb import UART, RTC, Pin, ExtInt, SPI
-import uctypes
+from pyb import UART, Pin, SPI
+# everything else is imported where it's brought up: the NIC driver and
+# packet codec with the socket, then the clock and GPS drivers once it's
+# bound and we're answering unsynchronised
 gc.collect()
 
-from syncedclock_rtc import SyncedClock_RTC
-gc.collect()
-
-from network import WIZNET5K
-
 import micropython
 micropython.alloc_emergency_exception_buf(100)
 
-ntpstruct = {
-    "mode": 0 | uctypes.BFUINT8 | 0 << uctypes.BF_POS | 3 << uctypes.BF_LEN,
-    "vn": 0 | uctypes.BFUINT8 | 3 << uctypes.BF_POS | 3 << uctypes.BF_LEN,
-    "li": 0 | uctypes.BFUINT8 | 6 << uctypes.BF_POS | 2 << uctypes.BF_LEN,
-    "stratum": 1 | uctypes.UINT8,
-    "poll": 2 | uctypes.INT8,
-    "precision": 3 | uctypes.INT8,
-    "root_delay": 4 | uctypes.UINT32,
-    "root_dispersion": 8 | uctypes.UINT32,
-    "reference_id": (12 | uctypes.ARRAY, 4 | uctypes.UINT8),
-    "reference_timestamp_s": 16 | uctypes.UINT32,
-    "reference_timestamp_frac": 20 | uctypes.UINT32,
-    "origin_timestamp_s": 24 | uctypes.UINT32,
-    "origin_timestamp_frac": 28 | uctypes.UINT32,
-    "receive_timestamp_s": 32 | uctypes.UINT32,
-    "receive_timestamp_frac": 36 | uctypes.UINT32,
-    "transmit_timestamp_s": 40 | uctypes.UINT32,
-    "transmit_timestamp_frac": 44 | uctypes.UINT32
-}
+# set to an (address, port) to send calibration telemetry to a collector
+# running telemetry_host.py
+telemetry_collector = None
 
-_NTP_LI_NOWARN = const(0)
-_NTP_LI_PLUSONE = const(1)
-_NTP_LI_MINUSONE = const(2)
-_NTP_LI_UNKNOWN = const(3)
+# upstream ntp servers to fall back on while the GPS isn't locked
+upstream_servers = []
 
-_NTP_MODE_CLIENT = const(3)
-_NTP_MODE_SERVER = const(4)
-
-_NTP_STRATUM_INVALID = const(0)
-_NTP_STRATUM_PRIMARY = const(1)
-_NTP_STRATUM_UNSYNCHRONISED = const(16)
-
-_NTP_REFID_0 = const(71) # 'G'
-_NTP_REFID_1 = const(80) # 'P'
-_NTP_REFID_2 = const(83) # 'S'
-_NTP_REFID_3 = const(0) # zero-pad
+# the synced clock, None until _start_clock has brought it up
+_clock = None
 
 # poller to ensure we get packets quickly
 async def _get_ntp_packet(poller):
@@ -83,76 +53,96 @@ async def _get_ntp_packet(poller):
         await uasyncio.sleep(0)
     return ev[0][0].recvfrom(90)
 
+async def _wait_link(nic):
+    while True:
+        if (nic.isconnected()):
+            break
+        await uasyncio.sleep_ms(100)
+    print("ntpd: nic reports connected after",utime.ticks_diff(utime.ticks_ms(),_boot_ms),"ms")
+
+# runs once the socket is up, the serve loop answers unsynchronised until
+# this has set _clock
+async def _start_clock(sock,nic):
+    global _clock
+    print("ntpd: starting synced clock service")
+    telemetry = None
+    if (telemetry_collector != None):
+        from telemetry import Telemetry
+        telemetry = Telemetry()
+    from syncedclock_rtc import SyncedClock_RTC
+    gc.collect()
+    clock = SyncedClock_RTC(gps_uart=UART(2,4800,read_buf_len=200),pps_pin=Pin(Pin.board.A1,Pin.IN),telemetry=telemetry)
+    await clock.start()
+    _clock = clock
+    if (telemetry != None):
+        print("ntpd: sending telemetry to",telemetry_collector)
+        uasyncio.get_event_loop().create_task(telemetry.export_task(lambda buf: sock.sendto(buf,telemetry_collector)))
+    if upstream_servers:
+        # resolving the servers needs the network, which may not be up yet
+        while not nic.isconnected():
+            await uasyncio.sleep_ms(100)
+        from ntpclient import NTPClient
+        uasyncio.get_event_loop().create_task(NTPClient(clock,upstream_servers).run())
+
 # ensures we're inside scheduling when we start to interact
 # with things
 async def _ntpd():
-    print("ntpd: starting synced clock service")
-    clock = SyncedClock_RTC(gps_uart=UART(2,4800,read_buf_len=200),pps_pin=Pin(Pin.board.A1,Pin.IN))
-    await clock.start()
     print("ntpd: listen on udp/123")
+    from network import WIZNET5K
     nic = WIZNET5K(SPI('Y'),Pin.board.B4,Pin.board.B3)
     nic.ifconfig(('10.32.34.100','255.255.255.0','10.32.34.1','8.8.8.8'))
-    while True:
-        if (nic.isconnected()):
-            break
-        await uasyncio.sleep_ms(100)
-    print("ntpd: nic reports connected")
+    # the chip takes the socket without link, so don't wait for it; packets
+    # just start arriving once it's up
     sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
     sock.bind(('',123))
     poller = uselect.poll()
     poller.register(sock,uselect.POLLIN)
+    import ntppacket
+    uasyncio.get_event_loop().create_task(_wait_link(nic))
+    # the clock and GPS come up behind the socket
+    uasyncio.get_event_loop().create_task(_start_clock(sock,nic))
     print("ntpd: starting loop for packets")
     # buffer for outbound packets
-    sendbuf = bytearray(48)
-    send_payload = uctypes.struct(uctypes.addressof(sendbuf),ntpstruct,uctypes.BIG_ENDIAN)
-    send_payload.mode = _NTP_MODE_SERVER
-    send_payload.vn = 4
-    send_payload.li = _NTP_LI_NOWARN
-    send_payload.root_delay = 0
-    send_payload.root_dispersion = 0
-    send_payload.poll = 6
-    send_payload.precision = -9
-    send_payload.reference_id[0] = _NTP_REFID_0
-    send_payload.reference_id[1] = _NTP_REFID_1
-    send_payload.reference_id[2] = _NTP_REFID_2
-    send_payload.reference_id[3] = _NTP_REFID_3
+    sendbuf = bytearray(ntppacket.NTP_PACKET_LEN)
+    ntppacket.init_reply(sendbuf)
+    last_source = None
+    # for the boot time benchmark, see bench_boot.py
+    reported_unsync = False
+    reported_primary = False
     while True:
         packet = await _get_ntp_packet(poller)
-        arrival = clock.now()
-        refclk = clock.refclk()
+        clock = _clock
+        arrival = None
+        if (clock != None):
+            # the clock swaps its source tuple whole, so take one snapshot
+            source = clock.source()
+            arrival = clock.now()
+            refclk = clock.refclk()
         await uasyncio.sleep(0)
-        ntp_payload = uctypes.struct(uctypes.addressof(packet[0]),ntpstruct,uctypes.BIG_ENDIAN)
-        if (clock.isLocked()):
-            send_payload.poll = ntp_payload.poll
-            if (ntp_payload.poll < 6):
-                send_payload.poll = 6
-            if (ntp_payload.poll > 10):
-                send_payload.poll = 10
-            send_payload.stratum = _NTP_STRATUM_PRIMARY
-            send_payload.reference_timestamp_s = refclk[0]+2208988800
-            send_payload.reference_timestamp_frac = refclk[1]
-            send_payload.receive_timestamp_s = arrival[0]+2208988800
-            send_payload.receive_timestamp_frac = arrival[1]
-            send_payload.origin_timestamp_s = ntp_payload.transmit_timestamp_s
-            send_payload.origin_timestamp_frac = ntp_payload.transmit_timestamp_frac
+        if (len(packet[0]) < ntppacket.NTP_PACKET_LEN):
+            continue
+        transmit = None
+        if (arrival != None):
+            if (source is not last_source):
+                ntppacket.set_refid(sendbuf,source[1])
+                last_source = source
+            ntppacket.fill_reply(sendbuf,packet[0],source[0],refclk,arrival)
             await uasyncio.sleep(0)
             transmit = clock.now()
-            send_payload.transmit_timestamp_s = transmit[0]+2208988800
-            send_payload.transmit_timestamp_frac = transmit[1]
+        if (transmit != None):
+            ntppacket.set_transmit(sendbuf,transmit)
         else:
             await uasyncio.sleep(0)
-            send_payload.stratum = _NTP_STRATUM_UNSYNCHRONISED
-            send_payload.reference_timestamp_s = 0
-            send_payload.reference_timestamp_frac = 0
-            send_payload.receive_timestamp_s = 0
-            send_payload.receive_timestamp_frac = 0
-            send_payload.origin_timestamp_s = 0
-            send_payload.origin_timestamp_frac = 0
-            send_payload.transmit_timestamp_s = 0
-            send_payload.transmit_timestamp_frac = 0
+            ntppacket.fill_unsynchronised(sendbuf)
             await uasyncio.sleep(0)
         # we should poll if it's okay to write, but anyway
         sock.sendto(sendbuf,packet[1])
+        if (not reported_primary and sendbuf[1] == ntppacket.NTP_STRATUM_PRIMARY):
+            reported_primary = True
+            print("ntpd: first stratum 1 reply after",utime.ticks_diff(utime.ticks_ms(),_boot_ms),"ms")
+        elif (not reported_unsync and sendbuf[1] == ntppacket.NTP_STRATUM_UNSYNCHRONISED):
+            reported_unsync = True
+            print("ntpd: first unsynchronised reply after",utime.ticks_diff(utime.ticks_ms(),_boot_ms),"ms")
         await uasyncio.sleep(0)
 
 def _gc():
@@ -0,0 +1,296 @@
+# ntpd for Linux hosts
+# the kernel clock is disciplined elsewhere (PPS from a serial GPS via
+# gpsd/chrony or similar), we just serve it as fast as we can using one
+# worker process per core all bound to udp/123 with SO_REUSEPORT
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import time
+from multiprocessing import shared_memory
+
+import ntppacket
+
+# shared clock state, written by the discipline process and read by every
+# worker. seq is a seqlock: odd while an update is in progress
+#   seq, reference seconds, reference fraction, locked, root dispersion
+_STATE_FMT = '=IIIII'
+_STATE_SIZE = struct.calcsize(_STATE_FMT)
+
+# how many packets a worker will drain per wakeup before re-reading the
+# shared clock state
+_BATCH = 32
+
+# a reference older than this many discipline intervals means the
+# discipline process has stopped updating, so stop claiming sync
+_MAX_AGE_INTERVALS = 4
+# give up on a consistent read after this many tries, a writer that died
+# mid-update leaves seq odd until it's restarted
+_READ_TRIES = 1000
+
+class ClockState():
+    def __init__(self, shm=None):
+        self._owner = shm is None
+        if shm is None:
+            shm = shared_memory.SharedMemory(create=True, size=_STATE_SIZE)
+        self._shm = shm
+        self._buf = shm.buf
+        if self._owner:
+            struct.pack_into(_STATE_FMT, self._buf, 0, 0, 0, 0, 0, 0)
+
+    def publish(self, locked, refclk, root_dispersion):
+        seq = struct.unpack_from('=I', self._buf, 0)[0]
+        # a previous writer may have died mid-update and left it odd
+        if not (seq & 1):
+            seq = (seq + 1) & 0xffffffff
+            struct.pack_into('=I', self._buf, 0, seq)
+        struct.pack_into('=IIII', self._buf, 4, refclk[0], refclk[1], 1 if locked else 0, root_dispersion)
+        struct.pack_into('=I', self._buf, 0, (seq + 1) & 0xffffffff)
+
+    # returns (locked, (reference seconds, fraction), root dispersion), or
+    # unlocked if no consistent copy could be had
+    def read(self):
+        for i in range(_READ_TRIES):
+            seq, ref_s, ref_frac, locked, disp = struct.unpack_from(_STATE_FMT, self._buf, 0)
+            if (seq & 1):
+                continue
+            if (struct.unpack_from('=I', self._buf, 0)[0] == seq):
+                return (locked == 1, (ref_s, ref_frac), disp)
+        return (False, (0, 0), 0)
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    # SharedMemory pickles by name, so this works for spawn as well as fork
+    def __reduce__(self):
+        return (_attach_state, (self._shm.name,))
+
+def _attach_state(name):
+    return ClockState(_attach_shm(name))
+
+def _attach_shm(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # only the creator should unlink it; keep the tracker from doing so too
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+# struct timex from <sys/timex.h>, only used to read sync status
+class _Timex(ctypes.Structure):
+    _fields_ = [('modes', ctypes.c_uint),
+                ('offset', ctypes.c_long),
+                ('freq', ctypes.c_long),
+                ('maxerror', ctypes.c_long),
+                ('esterror', ctypes.c_long),
+                ('status', ctypes.c_int),
+                ('constant', ctypes.c_long),
+                ('precision', ctypes.c_long),
+                ('tolerance', ctypes.c_long),
+                ('time_sec', ctypes.c_long),
+                ('time_usec', ctypes.c_long),
+                ('tick', ctypes.c_long),
+                ('ppsfreq', ctypes.c_long),
+                ('jitter', ctypes.c_long),
+                ('shift', ctypes.c_int),
+                ('stabil', ctypes.c_long),
+                ('jitcnt', ctypes.c_long),
+                ('calcnt', ctypes.c_long),
+                ('errcnt', ctypes.c_long),
+                ('stbcnt', ctypes.c_long),
+                ('tai', ctypes.c_int),
+                ('_reserved', ctypes.c_int * 11)]
+
+_TIME_ERROR = 5
+_STA_PPSTIME = 0x0004
+_STA_UNSYNC = 0x0040
+_STA_PPSSIGNAL = 0x0100
+
+def _now():
+    ns = time.time_ns()
+    s, ns = divmod(ns, 1000000000)
+    return (s, (ns << 32) // 1000000000)
+
+# returns (synced, maxerror in microseconds, kernel pps discipline) from
+# the kernel, or None if adjtimex isn't available to us
+def _kernel_sync_status(libc):
+    tx = _Timex()
+    try:
+        state = libc.adjtimex(ctypes.byref(tx))
+    except AttributeError:
+        return None
+    if (state < 0):
+        return None
+    synced = state != _TIME_ERROR and not (tx.status & _STA_UNSYNC)
+    pps = (tx.status & (_STA_PPSTIME | _STA_PPSSIGNAL)) == (_STA_PPSTIME | _STA_PPSSIGNAL)
+    return (synced, tx.maxerror, pps)
+
+# the discipline process: watch the kernel clock and publish its state
+# we only claim stratum 1 when the kernel is disciplined by PPS itself, or
+# the operator tells us a PPS refclock is steering it (chrony and ntpd
+# refclocks don't set the kernel PPS flags); a clock synced to upstream
+# servers over the network isn't a stratum 1 GPS source
+def _discipline(state, interval, assume_locked, pps_refclock):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    locked = False
+    warned = False
+    print("ntpd_host: discipline process started")
+    while True:
+        status = _kernel_sync_status(libc)
+        if assume_locked:
+            status = (True, 0, True)
+        if (status is not None and status[0] and not status[2] and not pps_refclock):
+            if not warned:
+                print("ntpd_host: kernel clock synced but not to PPS, serving unsynchronised")
+                warned = True
+            status = None
+        if (status is None or not status[0]):
+            if locked:
+                print("ntpd_host: kernel clock lost sync")
+            locked = False
+            state.publish(False, (0, 0), 0)
+        else:
+            if not locked:
+                print("ntpd_host: kernel clock synced, maxerror",status[1],"us")
+            locked = True
+            # root dispersion is NTP short format, 16.16 seconds
+            state.publish(True, _now(), (status[1] << 16) // 1000000)
+        time.sleep(interval)
+
+def _bind(address, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((address, port))
+    return sock
+
+# one of these per core, the kernel spreads clients across them by 4-tuple
+def _worker(state, address, port, core, batch, max_age):
+    if core is not None:
+        try:
+            os.sched_setaffinity(0, (core,))
+        except (AttributeError, OSError):
+            pass
+    sock = _bind(address, port)
+    sendbuf = bytearray(ntppacket.NTP_PACKET_LEN)
+    ntppacket.init_reply(sendbuf)
+    recvbufs = [bytearray(90) for i in range(batch)]
+    views = [memoryview(b) for b in recvbufs]
+    arrivals = [None] * batch
+    addrs = [None] * batch
+    lens = [0] * batch
+    flags = socket.MSG_DONTWAIT
+    while True:
+        # block for the first packet, then drain whatever else is queued
+        lens[0], addrs[0] = sock.recvfrom_into(recvbufs[0])
+        arrivals[0] = _now()
+        count = 1
+        while count < batch:
+            try:
+                lens[count], addrs[count] = sock.recvfrom_into(recvbufs[count], 0, flags)
+            except BlockingIOError:
+                break
+            arrivals[count] = _now()
+            count += 1
+        locked, refclk, disp = state.read()
+        # the reference is stamped each time it's published, so an old one
+        # means nobody is watching the kernel clock any more
+        if (locked and arrivals[0][0] - refclk[0] > max_age):
+            locked = False
+        for i in range(count):
+            if (lens[i] < ntppacket.NTP_PACKET_LEN):
+                continue
+            if locked:
+                ntppacket.fill_reply(sendbuf, views[i], ntppacket.NTP_STRATUM_PRIMARY, refclk, arrivals[i], disp)
+                ntppacket.set_transmit(sendbuf, _now())
+            else:
+                ntppacket.fill_unsynchronised(sendbuf)
+            try:
+                sock.sendto(sendbuf, addrs[i])
+            except OSError:
+                pass
+
+# (target, args) for the discipline process and each worker
+def _specs(state, address, port, workers, batch, interval, assume_locked, pps_refclock):
+    if workers is None:
+        workers = len(os.sched_getaffinity(0))
+    cores = sorted(os.sched_getaffinity(0))
+    max_age = max(1, int(interval * _MAX_AGE_INTERVALS))
+    specs = [(_discipline, (state, interval, assume_locked, pps_refclock))]
+    for i in range(workers):
+        core = cores[i % len(cores)]
+        specs.append((_worker, (state, address, port, core, batch, max_age)))
+    return specs
+
+# children always take SIGTERM the default way, whatever the parent has
+def _child(target, args):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(*args)
+
+def _run(spec):
+    p = multiprocessing.Process(target=_child, args=spec, daemon=True)
+    p.start()
+    return p
+
+# start the discipline process and workers, returns the processes so the
+# caller can join or terminate them
+def spawn(state, address='', port=123, workers=None, batch=_BATCH, interval=1.0, assume_locked=False, pps_refclock=False):
+    return [_run(spec) for spec in _specs(state, address, port, workers, batch, interval, assume_locked, pps_refclock)]
+
+def start(address='', port=123, workers=None, batch=_BATCH, assume_locked=False, pps_refclock=False, interval=1.0):
+    state = ClockState()
+    specs = _specs(state, address, port, workers, batch, interval, assume_locked, pps_refclock)
+    procs = [_run(spec) for spec in specs]
+    print("ntpd_host: listen on udp/"+str(port),"with",len(procs)-1,"workers")
+    # turn a service stop into the same clean exit as ^C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        # keep the discipline process and every worker running
+        while True:
+            time.sleep(interval)
+            for i, p in enumerate(procs):
+                if not p.is_alive():
+                    print("ntpd_host:",specs[i][0].__name__[1:],"process exited with",p.exitcode,"- restarting")
+                    procs[i] = _run(specs[i])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
+        state.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='serve NTP from the host clock')
+    parser.add_argument('--address', default='')
+    parser.add_argument('--port', type=int, default=123)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--batch', type=int, default=_BATCH)
+    parser.add_argument('--pps-refclock', action='store_true',
+                        help='the kernel clock is steered by a local PPS refclock (eg chrony refclock PPS)')
+    parser.add_argument('--assume-locked', action='store_true',
+                        help='serve stratum 1 even if the kernel clock is unsynced (testing only)')
+    args = parser.parse_args()
+    start(args.address, args.port, args.workers, args.batch, args.assume_locked, args.pps_refclock)
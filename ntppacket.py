@@ -0,0 +1,126 @@
+# Portable NTP packet codec
+# shared by the MicroPython ntpd and the Linux host server, so it sticks to
+# struct.pack_into on buffers rather than uctypes
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# packet layout, all big endian (see RFC5905 figure 8)
+#   0 li:2 vn:3 mode:3, 1 stratum, 2 poll (int8), 3 precision (int8)
+#   4 root delay, 8 root dispersion, 12 reference id
+#  16 reference, 24 origin, 32 receive, 40 transmit timestamps (s, frac)
+NTP_PACKET_LEN = const(48)
+
+_OFF_REFERENCE = const(16)
+_OFF_ORIGIN = const(24)
+_OFF_RECEIVE = const(32)
+_OFF_TRANSMIT = const(40)
+
+_NTP_LI_NOWARN = const(0)
+_NTP_LI_PLUSONE = const(1)
+_NTP_LI_MINUSONE = const(2)
+_NTP_LI_UNKNOWN = const(3)
+
+NTP_MODE_CLIENT = const(3)
+NTP_MODE_SERVER = const(4)
+
+NTP_STRATUM_INVALID = const(0)
+NTP_STRATUM_PRIMARY = const(1)
+NTP_STRATUM_UNSYNCHRONISED = const(16)
+
+_NTP_POLL_MIN = const(6)
+_NTP_POLL_MAX = const(10)
+
+# seconds between 1900-01-01 and 1970-01-01
+NTP_EPOCH_OFFSET = 2208988800
+
+_REFID_GPS = b'GPS\x00'
+_ZERO_TIMESTAMPS = bytes(NTP_PACKET_LEN - _OFF_REFERENCE)
+
+# set up the parts of an outbound buffer which never change between replies
+def init_reply(buf, refid=_REFID_GPS):
+    buf[0] = (_NTP_LI_NOWARN << 6) | (4 << 3) | NTP_MODE_SERVER
+    buf[1] = NTP_STRATUM_UNSYNCHRONISED
+    struct.pack_into('!bbII', buf, 2, _NTP_POLL_MIN, -9, 0, 0)
+    buf[12:16] = refid
+
+# write a (unix seconds, 32 bit fraction) tuple at the given offset
+def _set_timestamp(buf, offset, ts):
+    struct.pack_into('!II', buf, offset, (ts[0] + NTP_EPOCH_OFFSET) & 0xffffffff, ts[1])
+
+# fill everything bar the transmit timestamp for a synchronised reply;
+# request must be at least NTP_PACKET_LEN bytes
+def fill_reply(buf, request, stratum, refclk, arrival, root_dispersion=0):
+    poll = request[2]
+    if (poll > 127):
+        poll -= 256
+    if (poll < _NTP_POLL_MIN):
+        poll = _NTP_POLL_MIN
+    if (poll > _NTP_POLL_MAX):
+        poll = _NTP_POLL_MAX
+    buf[1] = stratum
+    buf[2] = poll
+    struct.pack_into('!I', buf, 8, root_dispersion)
+    _set_timestamp(buf, _OFF_REFERENCE, refclk)
+    # origin is the client's transmit timestamp echoed back verbatim
+    s, frac = struct.unpack_from('!II', request, _OFF_TRANSMIT)
+    struct.pack_into('!II', buf, _OFF_ORIGIN, s, frac)
+    _set_timestamp(buf, _OFF_RECEIVE, arrival)
+
+# done as late as possible before the reply goes out
+def set_transmit(buf, transmit):
+    _set_timestamp(buf, _OFF_TRANSMIT, transmit)
+
+# reply telling the client we have no usable time
+def fill_unsynchronised(buf):
+    buf[1] = NTP_STRATUM_UNSYNCHRONISED
+    struct.pack_into('!I', buf, 8, 0)
+    buf[_OFF_REFERENCE:NTP_PACKET_LEN] = _ZERO_TIMESTAMPS
+
+# reference id is the upstream's IPv4 address when we aren't stratum 1
+def set_refid(buf, refid):
+    buf[12:16] = refid
+
+# client mode request, transmit is also what the server echoes as origin
+def fill_request(buf, transmit):
+    buf[0] = (_NTP_LI_UNKNOWN << 6) | (4 << 3) | NTP_MODE_CLIENT
+    buf[1] = NTP_STRATUM_INVALID
+    struct.pack_into('!bbIII', buf, 2, _NTP_POLL_MIN, -9, 0, 0, 0)
+    buf[_OFF_REFERENCE:NTP_PACKET_LEN] = _ZERO_TIMESTAMPS
+    _set_timestamp(buf, _OFF_TRANSMIT, transmit)
+
+# (li, stratum, origin, receive, transmit) from a server reply with the
+# timestamps as (unix seconds, fraction), or None if it isn't one
+def parse_reply(buf):
+    if (len(buf) < NTP_PACKET_LEN or (buf[0] & 7) != NTP_MODE_SERVER):
+        return None
+    t = struct.unpack_from('!6I', buf, _OFF_ORIGIN)
+    return (buf[0] >> 6, buf[1],
+            (t[0] - NTP_EPOCH_OFFSET, t[1]),
+            (t[2] - NTP_EPOCH_OFFSET, t[3]),
+            (t[4] - NTP_EPOCH_OFFSET, t[5]))
+
+# a - b in units of 2^-32 seconds
+def timestamp_diff(a, b):
+    return ((a[0] - b[0]) << 32) + a[1] - b[1]
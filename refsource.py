@@ -0,0 +1,203 @@
+# Reference clock inputs and per-second source selection
+# a source is a 1PPS input, optionally with the GPS that labels its seconds;
+# no hardware in here so the simulator can run it on a host too
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# RTC subsecond ticks per second, phases below are all in these
+_TICKS = const(8192)
+_HALF_TICKS = const(4096)
+
+# most sources we'll look at each second, keeps selection a fixed cost
+MAX_SOURCES = const(4)
+# per-second frequency errors kept per source for jitter
+_STATS_LEN = const(16)
+# consecutive clean seconds before a source can be selected
+_MIN_GOOD = const(4)
+# a second to second step bigger than this is a glitch, not jitter
+_MAX_STEP = const(50)
+# disagreement with the median, in ticks, that makes a source a falseticker
+_MAX_DISAGREE = const(3)
+# how many of the best survivors get averaged together
+_MAX_COMBINE = const(3)
+# mean disagreement with the median, in ticks, that makes a source a
+# persistent falseticker
+_MAX_BIAS = const(1)
+# how far from the expected phase an edge may be and still belong to the
+# second, ticks (about 10ms)
+_WINDOW = const(82)
+
+def _wrap(ticks):
+    return (ticks + _HALF_TICKS) % _TICKS - _HALF_TICKS
+
+class RefSource():
+    def __init__(self, pps_pin=None, gps_uart=None, name=None):
+        self.pps_pin = pps_pin
+        self.gps_uart = gps_uart
+        self.gps = None
+        self.name = name
+        # written from the PPS interrupt
+        self.ssr = 0
+        self.fresh = False
+        # ring of per-second frequency error with running sums, so
+        # updating and reading the statistics doesn't depend on its length
+        self._ring = array('h', bytes(_STATS_LEN * 2))
+        self._idx = 0
+        self._n = 0
+        self._sum = 0
+        self._sumsq = 0
+        self._last_ssr = -1
+        self.good = 0
+        self.seen = 0
+        self.missed = 0
+        self.spurious = 0
+        # mean disagreement with the median, ticks * 16
+        self.offset16 = 0
+
+    # a PPS-only source is as good as its edges, otherwise the GPS has to
+    # agree it's got a fix
+    def usable(self):
+        return self.gps == None or self.gps.isLocked()
+
+    def _forget(self):
+        self._idx = 0
+        self._n = 0
+        self._sum = 0
+        self._sumsq = 0
+        self.good = 0
+
+    def _add(self, e):
+        if (self._n == _STATS_LEN):
+            old = self._ring[self._idx]
+            self._sum -= old
+            self._sumsq -= old * old
+        else:
+            self._n += 1
+        self._ring[self._idx] = e
+        self._sum += e
+        self._sumsq += e * e
+        self._idx = (self._idx + 1) % _STATS_LEN
+
+    # variance of the per-second frequency error, ticks^2 * n^2
+    def jitter(self):
+        if (self._n < 2):
+            return 0
+        return self._n * self._sumsq - self._sum * self._sum
+
+    # this wake's edge, if any: its phase, -1 if there's none, or -2 if it
+    # was outside the window around expected (or our own last edge while
+    # there's no combined phase)
+    def take(self, expected):
+        if not self.fresh:
+            return -1
+        self.fresh = False
+        ssr = self.ssr
+        if (expected == -1):
+            # nothing combined to go on, so judge it against our own last
+            # edge, and start again from this one if it's out
+            if (self._last_ssr != -1 and abs(_wrap(ssr - self._last_ssr)) > _WINDOW):
+                self.reject()
+                self._last_ssr = ssr
+                return -2
+        elif (abs(_wrap(ssr - expected)) > _WINDOW):
+            self.reject()
+            return -2
+        return ssr
+
+    # an edge that can't be the second's, it only counts against us
+    def reject(self):
+        self.fresh = False
+        self.spurious += 1
+        self._forget()
+
+    # the second went by without a usable edge from us
+    def miss(self):
+        self.missed += 1
+        self._last_ssr = -1
+        self._forget()
+
+    # this second's edge, update the statistics
+    def sample(self, ssr):
+        self.seen += 1
+        if (self._last_ssr != -1):
+            e = _wrap(ssr - self._last_ssr)
+            if (abs(e) > _MAX_STEP):
+                self._forget()
+            else:
+                self._add(e)
+                self.good += 1
+        self._last_ssr = ssr
+
+# edges seen too soon after a second to be the next one
+def reject(sources):
+    for s in sources:
+        if s.fresh:
+            s.reject()
+
+# pick and combine this second's phases; last is the previous combined phase
+# or -1. returns the new one, -1 if there was nothing good enough, or -2 if
+# no source had an edge in its window so this wasn't a second at all
+def select(sources, last):
+    phases = [s.take(last) for s in sources]
+    if (max(phases) < 0):
+        return -2
+    # (jitter, delta from last, source), at most MAX_SOURCES of them
+    candidates = []
+    for i in range(len(sources)):
+        s = sources[i]
+        ssr = phases[i]
+        if (ssr == -2):
+            # take() has already counted it against this source
+            continue
+        if (ssr == -1 or not s.usable()):
+            s.miss()
+            continue
+        s.sample(ssr)
+        if (last == -1):
+            last = ssr
+        if (s.good >= _MIN_GOOD):
+            candidates.append((s.jitter(), _wrap(ssr - last), s))
+    if not candidates:
+        return -1
+    deltas = sorted(c[1] for c in candidates)
+    median = deltas[len(deltas) // 2]
+    for jitter, d, s in candidates:
+        s.offset16 += (16 * (d - median) - s.offset16) // 8
+    survivors = [c for c in candidates if abs(c[1] - median) <= _MAX_DISAGREE]
+    # one that's always off to the same side still drags the average with
+    # it; it takes three to say which one that is
+    if (len(candidates) >= 3):
+        unbiased = [c for c in survivors if abs(c[2].offset16) <= 16 * _MAX_BIAS]
+        if unbiased:
+            survivors = unbiased
+    survivors.sort(key=lambda c: c[0])
+    survivors = survivors[:_MAX_COMBINE]
+    # weight by inverse jitter (scaled back down from n^2), the +1 stops
+    # a source that happens to be perfect taking all of the weight
+    total = 0
+    weights = 0
+    for jitter, delta, s in survivors:
+        w = 1 / (1 + jitter / (_STATS_LEN * _STATS_LEN))
+        total += w * delta
+        weights += w
+    delta = round(total / weights)
+    return (last + delta) % _TICKS
@@ -0,0 +1,154 @@
+# Reference source selection simulator
+# drives refsource.select with synthetic PPS inputs (jitter, outages,
+# glitches and spurious mid-second edges on a drifting RTC) the way the
+# calibration loop does, and compares each source alone against all of them
+# together, runs on a host
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import random
+
+import refsource
+
+_TICKS = 8192
+# as in syncedclock_rtc, in seconds
+_GATHER = 0.020
+_HOLDOFF = 0.500
+_STALE = 4.0
+
+# name, jitter (ticks rms), chance per second of an outage starting,
+# mean outage length (s), chance per second of a glitched edge, chance per
+# second of an extra edge somewhere in the second
+_PROFILES = [
+    ('gps-a', 0.6, 1/3600, 120, 1/2000, 0),
+    ('gps-b', 1.0, 1/1800, 300, 1/1000, 1/100),
+    ('pps-c', 0.4, 1/7200, 60, 1/5000, 0),
+]
+
+class _Input():
+    def __init__(self, rng, name, jitter, p_outage, outage_len, p_glitch, p_spurious):
+        self.rng = rng
+        self.jitter = jitter
+        self.p_outage = p_outage
+        self.outage_len = outage_len
+        self.p_glitch = p_glitch
+        self.p_spurious = p_spurious
+        self.down = 0
+        self.source = refsource.RefSource(name=name)
+
+    # this second's edges as (time, input, rtc phase), phase is where the
+    # RTC is at the true top of second t
+    def edges(self, t, phase):
+        out = []
+        if (self.rng.random() < self.p_spurious):
+            at = self.rng.uniform(-0.5, 0.5)
+            out.append((t + at, self, int(phase + at * _TICKS) % _TICKS))
+        if self.down:
+            self.down -= 1
+            return out
+        if (self.rng.random() < self.p_outage):
+            self.down = max(1, int(self.rng.expovariate(1 / self.outage_len)))
+            return out
+        edge = self.rng.gauss(0, self.jitter)
+        if (self.rng.random() < self.p_glitch):
+            edge += self.rng.choice((-1, 1)) * self.rng.randint(100, 2000)
+        out.append((t + edge / _TICKS, self, int(round(phase + edge)) % _TICKS))
+        return out
+
+    # like the PPS interrupt does
+    def deliver(self, ssr):
+        self.source.ssr = ssr
+        self.source.fresh = True
+
+def _wrap(ticks):
+    return (ticks + _TICKS // 2) % _TICKS - _TICKS // 2
+
+# every run sees the same RTC and the same input behaviour for a given
+# seed, only which inputs are wired to select differs
+def run(profiles, seconds, seed):
+    rng = random.Random(seed)
+    inputs = [_Input(random.Random(seed * 31 + [q[0] for q in _PROFILES].index(p[0])), *p) for p in profiles]
+    sources = [i.source for i in inputs]
+    phase = rng.uniform(0, _TICKS)
+    freq = 0.3
+    phases = []
+    events = []
+    for t in range(seconds):
+        # RTC drifting with a bit of random walk on its frequency
+        freq += rng.gauss(0, 0.002)
+        phase = (phase + freq) % _TICKS
+        phases.append(phase)
+        for i in inputs:
+            events.extend(i.edges(t, phase))
+    events.sort(key=lambda e: e[0])
+    last = -1
+    last_second = None
+    last_selected = None
+    up = 0
+    sq = 0.0
+    worst = 0
+    miss_run = 0
+    worst_run = 0
+    n = 0
+    while n < len(events):
+        # woken by the first edge, gather the rest, as _calibration_loop
+        wake = events[n][0]
+        while n < len(events) and events[n][0] <= wake + _GATHER:
+            events[n][1].deliver(events[n][2])
+            n += 1
+        now = wake + _GATHER
+        if (last_second != None and now - last_second < _HOLDOFF):
+            refsource.reject(sources)
+            continue
+        if (last_selected != None and now - last_selected > _STALE):
+            last = -1
+        out = refsource.select(sources, last)
+        if (out == -2):
+            continue
+        last_second = now
+        if (out == -1):
+            if (last != -1):
+                miss_run += 1
+                worst_run = max(worst_run, miss_run)
+            continue
+        miss_run = 0
+        last = out
+        last_selected = now
+        up += 1
+        t = min(max(int(round(wake)), 0), seconds - 1)
+        err = _wrap(out - phases[t])
+        sq += err * err
+        worst = max(worst, abs(err))
+    rms = math.sqrt(sq / up) if up else float('nan')
+    return (up / seconds, rms, worst, worst_run)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='compare single and combined reference sources')
+    parser.add_argument('--seconds', type=int, default=86400)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--spurious', type=float, default=None,
+                        help='chance per second of a spurious edge on gps-b')
+    args = parser.parse_args()
+    profiles = list(_PROFILES)
+    if args.spurious != None:
+        profiles[1] = profiles[1][:5] + (args.spurious,)
+    print('{:<20}  {:>9}  {:>10}  {:>10}  {:>9}'.format('sources', 'uptime', 'rms ticks', 'max ticks', 'max miss'))
+    runs = [[p] for p in profiles] + [profiles]
+    for run_profiles in runs:
+        uptime, rms, worst, worst_run = run(run_profiles, args.seconds, args.seed)
+        name = '+'.join(p[0] for p in run_profiles)
+        print('{:<20}  {:8.4f}%  {:10.3f}  {:10.1f}  {:9d}'.format(name, uptime * 100, rms, worst, worst_run))
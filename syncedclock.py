@@ -15,13 +15,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ntppacket
+
+# what we're serving as, (stratum, reference id)
+SOURCE_UNSYNCHRONISED = (ntppacket.NTP_STRATUM_UNSYNCHRONISED, b'\x00\x00\x00\x00')
+SOURCE_GPS = (ntppacket.NTP_STRATUM_PRIMARY, b'GPS\x00')
+
 class SyncedClock():
     def __init__(self, *args, **kwargs):
         self._locked = False
+        self._source = SOURCE_UNSYNCHRONISED
 
+    # true only when locked to our own reference clock
     def isLocked(self):
         return self._locked
 
+    # the (stratum, refid) tuple we should be serving, replaced whole
+    # so callers can tell it changed by identity
+    def source(self):
+        return self._source
+
     # it should return a tuple of (unix seconds, float subseconds) or None
     # if not locked
     def now(self):
@@ -31,6 +44,22 @@ class SyncedClock():
     def refclk(self):
         return None
 
+    # the local clock whether synced or not, for the upstream ntp client
+    def local_now(self):
+        return None
+
+    # bumped whenever the local clock is stepped underneath the ntp client
+    def epoch(self):
+        return 0
+
+    # apply an upstream ntp offset (in 2^-32 s) when we aren't locked
+    def ntp_update(self, offset, stratum, refid):
+        return
+
+    # upstream ntp has gone away too
+    def ntp_lost(self):
+        return
+
     # spawn any threads required and then exit from here
     async def start(self):
         print("start called in syncedclock")
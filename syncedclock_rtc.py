@@ -15,7 +15,8 @@
 # limitations under the License.
 
 import syncedclock
-from copernicus_gps import Copernicus_GPS as GPS
+import refsource
+from refsource import RefSource
 from pyb import RTC, Pin, ExtInt
 import uasyncio as asyncio
 from asyn import Event
@@ -53,49 +54,130 @@ class SyncedClock_RTC(syncedclock.SyncedClock):
 
 
     _RTC_MAX = const(8191)
+    # how long to wait after the first PPS edge for the other sources
+    _GATHER_MS = const(20)
+    # edges this soon after a second can't be the next one
+    _HOLDOFF_MS = const(500)
+    # a combined phase this old is no use for placing the next edges
+    _STALE_MS = const(4000)
+    # edges but no seconds for this long means the PPS is gone
+    _LOST_MS = const(3000)
+    # seconds without a selectable source before we call it lost
+    _MAX_SELECT_MISS = const(8)
+    # seconds to wait for a receiver to ack its configuration
+    _CONFIGURE_S = const(5)
 
     # wrap initialiser
     def __init__(self, *args, **kwargs):
         super().__init__(args, kwargs)
         self._uart = None
         self._pps_pin = None
+        self._sources = None
+        self._telemetry = None
         if kwargs is not None:
             if 'gps_uart' in kwargs:
                 self._uart = kwargs['gps_uart']
             if 'pps_pin' in kwargs:
                 self._pps_pin = kwargs['pps_pin']
+            if 'sources' in kwargs:
+                self._sources = kwargs['sources']
+            if 'telemetry' in kwargs:
+                self._telemetry = kwargs['telemetry']
 
-        if (self._uart == None):
-            raise ValueError("need a uart for the gps")
-        if (self._pps_pin == None):
-            raise ValueError("need a pin that gps sends 1pps to us on")
+        # a single gps_uart/pps_pin pair is just one source
+        if (self._sources == None):
+            if (self._uart == None):
+                raise ValueError("need a uart for the gps")
+            if (self._pps_pin == None):
+                raise ValueError("need a pin that gps sends 1pps to us on")
+            self._sources = [RefSource(pps_pin=self._pps_pin,gps_uart=self._uart,name='gps')]
+        if (len(self._sources) == 0 or len(self._sources) > refsource.MAX_SOURCES):
+            raise ValueError("need between 1 and "+str(refsource.MAX_SOURCES)+" reference sources")
+        for source in self._sources:
+            if (source.pps_pin == None):
+                raise ValueError("every reference source needs a 1pps pin")
+        if not any(source.gps_uart != None for source in self._sources):
+            raise ValueError("need at least one gps to label the seconds")
 
         # we also need the RTC device
         self._rtc = RTC()
         self._pps_event = Event()
         self._rtc_ssr = uctypes.struct(_RTC_BASE+_RTC_SSR_OFFSET,self._rtc_ssr_struct,uctypes.NATIVE)
         self._rtc_dr = uctypes.struct(_RTC_BASE+_RTC_DR_OFFSET,self._rtc_dr_struct,uctypes.NATIVE)
-        self._pps_rtc = 0
         self._pps_discard = 0
-        self._ss_offset = -10000
+        # served time is the RTC plus these, GPS sets the subsecond phase
+        # and upstream ntp may move both while the GPS isn't locked
+        self._ss_offset = 0
+        self._s_offset = 0
         self._refclk = (0,0,0,0,0,0)
+        self._epoch = 0
+        self._ntp_source = None
+        self._ntp_refclk = (0,0)
 
     # try to get some better perf out of this, it's staticish code
     @micropython.native
-    def _pps(self,p):
+    def _pps(self,source):
         # grab RTC data when we tick
         # we need to pull this directly out of the registers because we don't want to
         # allocate ram, and the RTC() module does
-        self._pps_rtc = self._rtc_ssr.ss
+        source.ssr = self._rtc_ssr.ss
         # need to read DR to nothing to unlock shadow registers
         self._pps_discard = self._rtc_dr.du
+        source.fresh = True
         self._pps_event.set()
         return
 
+    # any GPS with a fix will do to label the seconds
+    def _locked_gps(self):
+        for source in self._sources:
+            if (source.gps != None and source.gps.isLocked()):
+                return source.gps
+        return None
+
+    def _gps_lock(self,rtc_ss):
+        self._ss_offset = rtc_ss
+        self._s_offset = 0
+        self._locked = True
+        self._source = syncedclock.SOURCE_GPS
+
+    def _gps_unlock(self):
+        if self._locked:
+            # stop serving until upstream ntp (if any) picks us up
+            self._source = syncedclock.SOURCE_UNSYNCHRONISED
+        self._locked = False
+
+    # we've just set the RTC from the GPS, any ntp offsets are meaningless
+    def _rtc_stepped(self):
+        self._epoch += 1
+        self._ss_offset = 0
+        self._s_offset = 0
+        self._ntp_source = None
+        if not self._locked:
+            self._source = syncedclock.SOURCE_UNSYNCHRONISED
+
+    async def _configure_gps(self,gps,pps_mode,pps_polarity):
+        try:
+            await gps.set_auto_messages(['RMC'],1)
+            await gps.set_pps_mode(pps_mode,42,pps_polarity,0)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    # a dead or unplugged receiver never acks, don't let it hold up the rest
+    async def _configure_source(self,source,pps_mode,pps_polarity,done):
+        res = await asyncio.wait_for(self._configure_gps(source.gps,pps_mode,pps_polarity),_CONFIGURE_S)
+        if (res == False):
+            print("syncedclock_rtc: gps",source.name,"didn't ack its config, carrying on without it")
+        done.set(res)
+
+    def _print_sources(self):
+        for source in self._sources:
+            print("syncedclock_rtc: source",source.name,"seen",source.seen,"missed",source.missed,"spurious",source.spurious,"offset",source.offset16/16)
+
     async def _wait_gpslock(self):
         try:
             while True:
-                if (self._gps.isLocked()):
+                if (self._locked_gps() != None):
                     return True
                 await asyncio.sleep(1)
         except asyncio.TimeoutError:
@@ -116,23 +198,39 @@ class SyncedClock_RTC(syncedclock.SyncedClock):
         # start RTC
         print("syncedclock_rtc: start rtc")
         self._rtc.init()
-        # initalise gps
-        self._gps = GPS(self._uart)
-        ppsint = ExtInt(self._pps_pin, ExtInt.IRQ_RISING, Pin.PULL_NONE, self._pps)
-        ppsint.disable()
+        # the gps driver is only needed from here, so it isn't loaded
+        # until the calibration loop runs
+        from copernicus_gps import Copernicus_GPS as GPS
+        # initalise gps and pps inputs
+        ppsints = []
+        for source in self._sources:
+            if (source.gps_uart != None):
+                source.gps = GPS(source.gps_uart)
+            ppsints.append(ExtInt(source.pps_pin, ExtInt.IRQ_RISING, Pin.PULL_NONE, lambda p, source=source: self._pps(source)))
+        for ppsint in ppsints:
+            ppsint.disable()
         self._pps_event.clear()
         await asyncio.sleep(0)
         while True:
             print("syncedclock_rtc: initalise gps")
-            await self._gps.set_auto_messages(['RMC'],1)
-            await self._gps.set_pps_mode(GPS.PPS_Mode.FIX,42,GPS.PPS_Polarity.ACTIVE_HIGH,0)
+            # each receiver takes a while to ack, do them all at once
+            loop = asyncio.get_event_loop()
+            pending = []
+            for source in self._sources:
+                if (source.gps != None):
+                    done = Event()
+                    loop.create_task(self._configure_source(source,GPS.PPS_Mode.FIX,GPS.PPS_Polarity.ACTIVE_HIGH,done))
+                    pending.append(done)
+            for done in pending:
+                await done
             print("syncedclock_rtc: waiting for gps lock (30s)")
             res = await asyncio.wait_for(self._wait_gpslock(),30)
             if (res == False):
                 continue
             print("syncedclock_rtc: gps locked, start pps interrupt and wait for pps (3s)")
             #self._pps_pin.irq(trigger=Pin.IRQ_RISING, handler=self._pps)
-            ppsint.enable()
+            for ppsint in ppsints:
+                ppsint.enable()
             res = await asyncio.wait_for(self._wait_pps(),3)
             if (res == False):
                 print("syncedclock_rtc: pps signal never recieved, bad wiring?")
@@ -142,11 +240,20 @@ class SyncedClock_RTC(syncedclock.SyncedClock):
             # so the GPS data contains the *previous* second at this point
             # add 1 second and reset RTC
             print("syncedclock_rtc: pps pulse recieved, set RTC clock")
+            self._gps = self._locked_gps()
+            if (self._gps == None):
+                # the fix went while we waited for the edge, which could
+                # have come from any source, so there's nothing to label it
+                print("syncedclock_rtc: gps lost its fix, reinit gps")
+                for ppsint in ppsints:
+                    ppsint.disable()
+                continue
             date = self._gps.date()
             time = self._gps.time()
             # helpfully utime and pyb.RTC use different order in the tuple
             now = utime.localtime(utime.mktime((date[2],date[1],date[0],time[0],time[1],time[2],0,0))+1)
             self._rtc.datetime((now[0],now[1],now[2],0,now[3],now[4],now[5],0))
+            self._rtc_stepped()
             print("syncedclock_rtc: rtc clock now",self._rtc.datetime())
             await asyncio.sleep(0)
             print("syncedclock_rtc: calibration loop started")
@@ -155,16 +262,53 @@ class SyncedClock_RTC(syncedclock.SyncedClock):
             # count 32 seconds and calculate the error
             count = 0
             tick_error = 0
+            select_miss = 0
+            # we've just had a second, and the RTC phase is new
+            last_second = utime.ticks_ms()
+            last_selected = last_second
+            for source in self._sources:
+                source.fresh = False
             while True:
                 # each time we get an PPS event, work out the ticks difference
                 res = await asyncio.wait_for(self._wait_pps(),3)
-                if (res == False):
+                # stray edges can keep waking us without there being seconds
+                if (res == False or utime.ticks_diff(utime.ticks_ms(),last_second) > _LOST_MS):
                     print("syncedclock_rtc: lost pps signal, restarting")
-                    self._locked = False
+                    self._gps_unlock()
                     #self._pps_pin.irq(handler=None)
-                    ppsint.disable()
+                    for ppsint in ppsints:
+                        ppsint.disable()
                     break
-                rtc_ss = self._pps_rtc
+                # let the other sources' edges for this second arrive, then
+                # pick and combine the good ones
+                await asyncio.sleep_ms(_GATHER_MS)
+                self._pps_event.clear()
+                now_ms = utime.ticks_ms()
+                if (utime.ticks_diff(now_ms,last_second) < _HOLDOFF_MS):
+                    # late or stray edges, they only count against their source
+                    refsource.reject(self._sources)
+                    continue
+                expected = last_rtc_ss
+                if (utime.ticks_diff(now_ms,last_selected) > _STALE_MS):
+                    expected = -1
+                rtc_ss = refsource.select(self._sources,expected)
+                if (rtc_ss == -2):
+                    # no edge near where the second should be, not a second
+                    continue
+                last_second = now_ms
+                if (rtc_ss == -1):
+                    # still qualifying sources or none are any good
+                    if (last_rtc_ss != -1):
+                        select_miss += 1
+                    if (select_miss == _MAX_SELECT_MISS):
+                        print("syncedclock_rtc: no usable reference source, restarting")
+                        self._gps_unlock()
+                        for ppsint in ppsints:
+                            ppsint.disable()
+                        break
+                    continue
+                select_miss = 0
+                last_selected = now_ms
                 await asyncio.sleep(0)
                 # first pass, just discard the value
                 if (last_rtc_ss == -1):
@@ -182,6 +326,8 @@ class SyncedClock_RTC(syncedclock.SyncedClock):
                         error = (rtc_ss - last_rtc_ss + _RTC_MAX+1)
                 await asyncio.sleep(0)
                 #print(error)
+                if (self._telemetry != None):
+                    self._telemetry.record(error,self._rtc.calibration(),self._locked)
                 tick_error += (error)
                 last_rtc_ss = rtc_ss
                 # always use the last top of second as current offset if it's not a huge error
@@ -194,13 +340,13 @@ class SyncedClock_RTC(syncedclock.SyncedClock):
                     # we're only then about 3.81ppm but that's close enough
                     if (self._locked == True and (tick_error > 1 or tick_error < -1)):
                         print("syncedclock_rtc: lost lock")
-                        self._locked = False
+                        self._gps_unlock()
                     await asyncio.sleep(0)
                     if (self._locked == False and (tick_error <= 1 and tick_error >= -1)):
                         print("syncedclock_rtc: locked with",self._rtc.calibration())
+                        self._print_sources()
                         # only cache top of second when we enter lock
-                        #self._ss_offset = (_RTC_MAX-rtc_ss)
-                        self._locked = True
+                        self._gps_lock(rtc_ss)
                     await asyncio.sleep(0)
                     if (self._locked == True):
                         # update reference clock point
@@ -208,6 +354,7 @@ class SyncedClock_RTC(syncedclock.SyncedClock):
                     await asyncio.sleep(0)
                     if (self._locked == False):
                         print("syncedclock_rtc: error now",tick_error)
+                        self._print_sources()
                     # the total ticks missing should be applied to the calibration
                     # we do this continously so we can ensure the clock is always remaining in sync
                     await asyncio.sleep(0)
@@ -221,14 +368,14 @@ class SyncedClock_RTC(syncedclock.SyncedClock):
                     count = 0
                     tick_error = 0
 
-    def _rtc_to_unixtime(self,rtc_tuple,rtc_offset):
+    def _rtc_to_unixtime(self,rtc_tuple,rtc_offset,s_offset=0):
         ts = utime.mktime((rtc_tuple[0], # year
                          rtc_tuple[1], # month
                          rtc_tuple[2], # day
                          rtc_tuple[4], # hour
                          rtc_tuple[5], # minute
                          rtc_tuple[6], # second
-                         0,0)) + 946684800 # weekday and dayofyear are ignored
+                         0,0)) + 946684800 + s_offset # weekday and dayofyear are ignored
         tss = (_RTC_MAX - rtc_tuple[7]) + rtc_offset
         if tss >= _RTC_MAX:
             tss -= _RTC_MAX+1
@@ -239,14 +386,40 @@ class SyncedClock_RTC(syncedclock.SyncedClock):
         return (ts,tss << 19)
 
     def now(self):
-        if not self._locked:
+        if self._source is syncedclock.SOURCE_UNSYNCHRONISED:
             return None
-        return self._rtc_to_unixtime(self._rtc.datetime(), self._ss_offset)
+        return self._rtc_to_unixtime(self._rtc.datetime(), self._ss_offset, self._s_offset)
 
     def refclk(self):
+        if self._locked:
+            return self._rtc_to_unixtime(self._refclk, self._ss_offset)
+        if self._ntp_source != None:
+            return self._ntp_refclk
+        return None
+
+    def local_now(self):
+        return self._rtc_to_unixtime(self._rtc.datetime(), self._ss_offset, self._s_offset)
+
+    def epoch(self):
+        return self._epoch
+
+    def ntp_update(self, offset, stratum, refid):
+        if self._locked:
+            return
+        # round to RTC ticks and fold into our offsets
+        ticks = (offset + (1 << 18)) >> 19
+        total = self._s_offset * (_RTC_MAX+1) + self._ss_offset + ticks
+        self._s_offset, self._ss_offset = divmod(total, _RTC_MAX+1)
+        self._ntp_refclk = self.local_now()
+        if (self._ntp_source == None or self._ntp_source != (stratum, refid)):
+            print("syncedclock_rtc: upstream ntp sync at stratum",stratum)
+            self._ntp_source = (stratum, refid)
+        self._source = self._ntp_source
+
+    def ntp_lost(self):
+        self._ntp_source = None
         if not self._locked:
-            return None
-        return self._rtc_to_unixtime(self._refclk, self._ss_offset)
+            self._source = syncedclock.SOURCE_UNSYNCHRONISED
 
     async def start(self):
         super().start()
@@ -0,0 +1,67 @@
+# Calibration telemetry ring buffer
+# keeps per-PPS RTC tick error, calibration and lock state in a fixed
+# buffer so we can export it in bulk for offline analysis (telemetry_host.py)
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uasyncio as asyncio
+import ustruct as struct
+
+# each record is three little endian int16: tick error, calibration, locked
+_RECORD = const(6)
+# frame is '<4sIH' magic, sequence number of first record, record count
+# followed by the records
+_HEADER = const(10)
+_MAX_PER_FRAME = const(64)
+
+class Telemetry():
+    def __init__(self, seconds=512):
+        self._size = seconds
+        # allocate everything up front, record() runs every second
+        # bytes rather than an array('h') so export can slice-copy it
+        self._ring = bytearray(seconds * _RECORD)
+        self._ring_view = memoryview(self._ring)
+        self._frame = bytearray(_HEADER + _MAX_PER_FRAME * _RECORD)
+        self._frame_view = memoryview(self._frame)
+        self._frame[0:4] = b'NTPT'
+        # total records written, and the first one not yet exported
+        self._seq = 0
+        self._sent = 0
+
+    def record(self, error, calibration, locked):
+        struct.pack_into('<hhh', self._ring, (self._seq % self._size) * _RECORD, error, calibration, 1 if locked else 0)
+        self._seq += 1
+
+    # hand everything recorded since the last export to write() as frames,
+    # write is anything taking a buffer, eg uart.write or a sendto wrapper
+    async def export(self, write):
+        if (self._seq - self._sent > self._size):
+            # we fell behind, the oldest records are already overwritten
+            # the collector sees the gap in sequence numbers
+            self._sent = self._seq - self._size
+        while self._sent < self._seq:
+            start = self._sent % self._size
+            n = min(self._seq - self._sent, self._size - start, _MAX_PER_FRAME)
+            struct.pack_into('<IH', self._frame, 4, self._sent & 0xffffffff, n)
+            length = _HEADER + n * _RECORD
+            self._frame[_HEADER:length] = self._ring_view[start*_RECORD:(start+n)*_RECORD]
+            write(self._frame_view[0:length])
+            self._sent += n
+            await asyncio.sleep(0)
+
+    async def export_task(self, write, interval=16):
+        while True:
+            await asyncio.sleep(interval)
+            await self.export(write)
@@ -0,0 +1,221 @@
+# Host side collector and stability analysis for calibration telemetry
+# frames come from telemetry.py on the device, over UDP or a UART capture
+
+# Copyright 2018 David Zanetti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_MAGIC = b'NTPT'
+_HEADER = struct.Struct('<4sIH')
+_RECORD = 3
+
+# RTC subsecond ticks per second (syncedclock_rtc _RTC_MAX + 1)
+TICKS_PER_SECOND = 8192
+# one step of STM32 smooth calibration is 2^-20, in ticks per second
+_TICKS_PER_CAL_STEP = TICKS_PER_SECOND / (1 << 20)
+
+# frames are appended verbatim to the capture file, so a UDP capture and a
+# raw UART capture parse the same way
+def collect_udp(path, port=12301, address=''):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((address, port))
+    expected = None
+    with open(path, 'ab') as f:
+        while True:
+            frame, peer = sock.recvfrom(2048)
+            if (len(frame) < _HEADER.size or frame[0:4] != _MAGIC):
+                continue
+            magic, seq, n = _HEADER.unpack_from(frame)
+            if (expected is not None and seq != expected):
+                print("telemetry: gap of",seq-expected,"records from",peer)
+            expected = seq + n
+            f.write(frame)
+            f.flush()
+
+# yields (sequence, int16 records shaped (n, 3)) skipping any line noise
+def parse_frames(data):
+    pos = 0
+    while True:
+        pos = data.find(_MAGIC, pos)
+        if (pos < 0 or pos + _HEADER.size > len(data)):
+            return
+        magic, seq, n = _HEADER.unpack_from(data, pos)
+        end = pos + _HEADER.size + n * _RECORD * 2
+        if (end > len(data)):
+            return
+        records = np.frombuffer(data, dtype='<i2', count=n * _RECORD, offset=pos + _HEADER.size)
+        yield seq, records.reshape(n, _RECORD)
+        pos = end
+
+# returns a dict of per-second arrays indexed from the first record seen:
+# error (float ticks, NaN in gaps), calibration, locked and valid
+def load(path):
+    if np is None:
+        raise ImportError("telemetry analysis needs numpy")
+    with open(path, 'rb') as f:
+        data = f.read()
+    frames = list(parse_frames(data))
+    if not frames:
+        raise ValueError("no telemetry frames in "+path)
+    first = min(seq for seq, records in frames)
+    last = max(seq + len(records) for seq, records in frames)
+    n = last - first
+    error = np.full(n, np.nan)
+    calibration = np.zeros(n, dtype=np.int16)
+    locked = np.zeros(n, dtype=bool)
+    valid = np.zeros(n, dtype=bool)
+    for seq, records in frames:
+        i = seq - first
+        j = i + len(records)
+        error[i:j] = records[:, 0]
+        calibration[i:j] = records[:, 1]
+        locked[i:j] = records[:, 2] != 0
+        valid[i:j] = True
+    return {'error': error, 'calibration': calibration, 'locked': locked, 'valid': valid}
+
+# per-second fractional frequency; with free_running the calibration the
+# loop applied is added back, leaving the bare oscillator
+def frequency(t, free_running=False):
+    y = t['error'].copy()
+    if free_running:
+        y += t['calibration'] * _TICKS_PER_CAL_STEP
+    return y / TICKS_PER_SECOND
+
+# phase (TIE against the PPS, in seconds) for each contiguous run of data,
+# gaps lose the phase so each run starts again from zero
+def phase_segments(y, tau0=1.0):
+    good = ~np.isnan(y)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], good.view(np.int8), [0]))))
+    return [np.concatenate(([0.0], np.cumsum(y[a:b]) * tau0)) for a, b in zip(edges[0::2], edges[1::2])]
+
+def octave_taus(segments):
+    longest = max(len(x) for x in segments)
+    m = 1
+    taus = []
+    while 3 * m < longest:
+        taus.append(m)
+        m <<= 1
+    return np.array(taus, dtype=np.int64)
+
+# overlapping Allan deviation
+def adev(segments, taus, tau0=1.0):
+    out = np.full(len(taus), np.nan)
+    for k, m in enumerate(taus):
+        total = 0.0
+        count = 0
+        for x in segments:
+            if (len(x) <= 2 * m):
+                continue
+            d = x[2*m:] - 2 * x[m:-m] + x[:-2*m]
+            total += np.dot(d, d)
+            count += len(d)
+        if count:
+            out[k] = np.sqrt(total / (2.0 * count * (m * tau0) ** 2))
+    return out
+
+# modified Allan deviation, the inner m-sum done with a cumulative sum
+def mdev(segments, taus, tau0=1.0):
+    out = np.full(len(taus), np.nan)
+    for k, m in enumerate(taus):
+        total = 0.0
+        count = 0
+        for x in segments:
+            if (len(x) < 3 * m + 1):
+                continue
+            d = x[2*m:] - 2 * x[m:-m] + x[:-2*m]
+            c = np.concatenate(([0.0], np.cumsum(d)))
+            s = c[m:] - c[:-m]
+            total += np.dot(s, s)
+            count += len(s)
+        if count:
+            out[k] = np.sqrt(total / (2.0 * count * m ** 2 * (m * tau0) ** 2))
+    return out
+
+# maximum time interval error over windows of m seconds, windows for each
+# octave are built from the previous one so it stays O(n) per tau
+def mtie(segments, taus):
+    out = np.full(len(taus), np.nan)
+    for x in segments:
+        hi = x
+        lo = x
+        width = 1
+        for k, m in enumerate(taus):
+            while width < m + 1:
+                step = min(width, m + 1 - width)
+                if (len(hi) <= step):
+                    break
+                hi = np.maximum(hi[:-step], hi[step:])
+                lo = np.minimum(lo[:-step], lo[step:])
+                width += step
+            if (width != m + 1):
+                break
+            worst = np.max(hi - lo)
+            if (np.isnan(out[k]) or worst > out[k]):
+                out[k] = worst
+    return out
+
+# seconds from each loss of lock (or the start of the capture) until the
+# loop next reports lock, as a list of (record index, seconds); gaps in the
+# capture don't count as a loss of lock
+def time_to_lock(t):
+    idx = np.flatnonzero(t['valid'])
+    locked = t['locked'][idx]
+    change = np.flatnonzero(np.diff(locked.view(np.int8))) + 1
+    starts = [0] if not locked[0] else []
+    starts += [i for i in change if not locked[i]]
+    ends = [i for i in change if locked[i]]
+    result = []
+    for s in starts:
+        after = [e for e in ends if e > s]
+        if after:
+            result.append((int(idx[s]), int(idx[after[0]] - idx[s])))
+    return result
+
+def report(path, free_running=False):
+    t = load(path)
+    segments = phase_segments(frequency(t, free_running))
+    taus = octave_taus(segments)
+    print("records:",len(t['error']),"missing:",int(np.count_nonzero(~t['valid'])),
+          "locked:",int(np.count_nonzero(t['locked'])))
+    worst = max(np.max(np.abs(x)) for x in segments)
+    print("max |TIE|: {:.6e} s".format(worst))
+    for start, seconds in time_to_lock(t):
+        print("lock after",seconds,"s from record",start)
+    print("{:>8}  {:>12}  {:>12}  {:>12}".format('tau', 'adev', 'mdev', 'mtie'))
+    for row in zip(taus, adev(segments, taus), mdev(segments, taus), mtie(segments, taus)):
+        print("{:8d}  {:12.4e}  {:12.4e}  {:12.4e}".format(*row))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='collect and analyse calibration telemetry')
+    sub = parser.add_subparsers(dest='command', required=True)
+    c = sub.add_parser('collect', help='append telemetry frames from udp to a capture file')
+    c.add_argument('path')
+    c.add_argument('--port', type=int, default=12301)
+    a = sub.add_parser('analyse', help='stability report for a udp or uart capture file')
+    a.add_argument('path')
+    a.add_argument('--free-running', action='store_true',
+                   help='add back applied calibration to analyse the bare oscillator')
+    args = parser.parse_args()
+    if (args.command == 'collect'):
+        collect_udp(args.path, args.port)
+    else:
+        report(args.path, args.free_running)